@@ -0,0 +1,111 @@
+"""
+TCP Chat Application - Traffic Capture
+
+This module defines the binary trace format used to record the traffic a server
+receives, so it can be replayed later with replay.py. A trace starts with a short
+header followed by one record per event:
+
+    header: magic (4 bytes) + version (1 byte)
+    record: timestamp in microseconds since the capture started (8 bytes),
+            connection ID (4 bytes), event type (1 byte), payload length (4 bytes),
+            followed by the payload
+
+All integers are little-endian. Events are OPEN and CLOSE for chat connections and
+DATA for every chunk of bytes received from a client, exactly as recv() returned it.
+The server calls flush_if_due() on every pass of its loop, which runs at least once
+a second, so a server that is killed loses at most about the last two seconds of
+records even when traffic has stopped; an incomplete final record is ignored when
+reading.
+"""
+import time
+import struct
+
+TRACE_MAGIC = b'WCTR'
+TRACE_VERSION = 1
+
+HEADER = struct.Struct('<4sB')
+RECORD = struct.Struct('<QIBI')
+
+FLUSH_INTERVAL = 1.0  # Seconds between flushes of the trace file
+
+# Event types
+EVENT_OPEN = 0   # A client connected
+EVENT_DATA = 1   # Bytes received from a client
+EVENT_CLOSE = 2  # A client disconnected
+
+
+class TraceWriter:
+    """Record inbound chat traffic to a trace file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.started = time.perf_counter()
+        self.connections = {}  # Socket -> connection ID
+        self.next_id = 1
+        self.next_flush = self.started + FLUSH_INTERVAL
+
+    def _write(self, connection_id, event, payload=b''):
+        """Append one record to the trace."""
+        timestamp = int((time.perf_counter() - self.started) * 1_000_000)
+        self.file.write(RECORD.pack(timestamp, connection_id, event, len(payload)) + payload)
+
+    def flush_if_due(self):
+        """Flush the trace file if FLUSH_INTERVAL has passed since the last flush."""
+        now = time.perf_counter()
+        if now >= self.next_flush:
+            self.file.flush()
+            self.next_flush = now + FLUSH_INTERVAL
+
+    def opened(self, sock):
+        """Record a new client connection."""
+        self.connections[sock] = self.next_id
+        self.next_id += 1
+        self._write(self.connections[sock], EVENT_OPEN)
+
+    def received(self, sock, data):
+        """Record bytes received from a client."""
+        if sock in self.connections and data:
+            self._write(self.connections[sock], EVENT_DATA, data)
+
+    def closed(self, sock):
+        """Record a client disconnecting."""
+        connection_id = self.connections.pop(sock, None)
+        if connection_id is not None:
+            self._write(connection_id, EVENT_CLOSE)
+
+    def close(self):
+        """Flush and close the trace file."""
+        self.file.close()
+
+
+def read_trace(path):
+    """
+    Read the records of a trace file.
+
+    Args:
+        path: Path of the trace file
+
+    Yields:
+        (timestamp, connection_id, event, payload) tuples, with the timestamp in
+        seconds since the capture started
+
+    Raises:
+        ValueError: If the file is not a trace
+    """
+    with open(path, 'rb') as file:
+        header = file.read(HEADER.size)
+        if len(header) < HEADER.size or HEADER.unpack(header) != (TRACE_MAGIC, TRACE_VERSION):
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} chat trace")
+
+        while True:
+            record = file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+
+            timestamp, connection_id, event, length = RECORD.unpack(record)
+            payload = file.read(length)
+            if len(payload) < length:
+                return
+            yield timestamp / 1_000_000, connection_id, event, payload
@@ -5,7 +5,10 @@ This module implements the client side of a TCP-based chat application.
 It connects to the server and supports username registration, commands, and private messaging.
 """
 
+import os
+import re
 import socket
+import secrets
 import threading
 import logging
 
@@ -13,6 +16,11 @@ import logging
 from common import (
     HOST as SERVER_HOST,
     PORT as SERVER_PORT,
+    TRANSFER_PORT,
+    TRANSFER_CHUNK_SIZE,
+    TRANSFER_PUT,
+    TRANSFER_GET,
+    DOWNLOAD_DIR,
     BUFFER_SIZE,
     COMMANDS
 )
@@ -28,6 +36,17 @@ logger = logging.getLogger('client')
 # Global variables
 running = True  # Flag to control the receive thread
 username = None  # The client's username
+pending_uploads = {}  # Transfer token -> path of a file waiting to be accepted by the server
+offers = {}  # Download ticket -> (filename, size) of files other users offered, in the order received
+
+# Server messages about file transfers. The server ends every message with a
+# newline and removes newlines from what users send, so these are matched at the
+# start of each line and text quoted inside other users' chat cannot trigger them
+TRANSFER_ACCEPTED = re.compile(r"\[\d\d:\d\d:\d\d\] \[SERVER\] Transfer (\w+) accepted")
+TRANSFER_REJECTED = re.compile(r"\[\d\d:\d\d:\d\d\] \[ERROR\] Transfer (\w+) rejected")
+INCOMING_FILE = re.compile(
+    r"\[\d\d:\d\d:\d\d\] \[FILE\] Incoming file '(.+?)' \((\d+) bytes\) from .+? \[transfer (\w+)\]"
+)
 
 def display_help():
     """Display help information about available commands."""
@@ -36,6 +55,172 @@ def display_help():
         print(f"  {cmd} - {desc}")
     print("-------------------------")
 
+def request_transfer(client_socket, message):
+    """
+    Ask the server to relay a file typed as "/send <username> <path>" or "/share <path>".
+
+    The file is not sent over the chat connection. The server is told the file's
+    name and size along with a random token, and the upload starts on a separate
+    data connection once the server accepts the token.
+
+    Args:
+        client_socket: Socket connected to the server
+        message: The command typed by the user
+    """
+    cmd, _, args = message.partition(' ')
+    if cmd == '/send':
+        # Both usernames and paths may contain spaces, so use the longest
+        # trailing part that names an existing file and fall back to the last word
+        args = args.strip()
+        recipient, _, path = args.rpartition(' ')
+        for index, char in enumerate(args):
+            if char == ' ' and os.path.isfile(args[index + 1:]):
+                recipient, path = args[:index], args[index + 1:]
+                break
+    else:
+        recipient, path = None, args.strip()
+
+    if not path or (cmd == '/send' and not recipient):
+        print(f"Usage: {COMMANDS[cmd].split(': ', 1)[1]}")
+        return
+
+    if not os.path.isfile(path):
+        print(f"[!] File not found: {path}")
+        return
+
+    token = secrets.token_hex(8)
+    size = os.path.getsize(path)
+    filename = os.path.basename(path).replace(' ', '_')
+    pending_uploads[token] = path
+
+    if recipient:
+        request = f"/send {token} {size} {filename} {recipient}"
+    else:
+        request = f"/share {token} {size} {filename}"
+    client_socket.send(request.encode('utf-8'))
+    logger.info(f"Requested transfer {token} for '{path}' ({size} bytes)")
+
+def upload_file(token, path):
+    """
+    Upload a file over a data connection once the server has accepted the transfer.
+
+    Uses socket.sendfile() so the file is copied to the socket by the kernel
+    without passing through user space.
+
+    Args:
+        token: The transfer token accepted by the server
+        path: Path of the file to upload
+    """
+    try:
+        with socket.create_connection((SERVER_HOST, TRANSFER_PORT), timeout=10) as data_socket, \
+                open(path, 'rb') as file:
+            data_socket.settimeout(None)
+            data_socket.sendall(f"{TRANSFER_PUT} {token}\n".encode('utf-8'))
+            sent = data_socket.sendfile(file)
+        logger.info(f"Uploaded '{path}' ({sent} bytes)")
+    except Exception as e:
+        print(f"\n[!] Upload of '{path}' failed: {e}")
+        logger.error(f"Upload of '{path}' failed: {e}")
+        print("Enter message (or '/help' for commands): ", end='', flush=True)
+
+def download_file(ticket, filename, size):
+    """
+    Download a file offered by another user into DOWNLOAD_DIR.
+
+    Chunks are received into a reusable buffer and written straight to disk. The
+    file is only created once the server starts sending data.
+
+    Args:
+        ticket: The download ticket sent by the server
+        filename: Name of the file being received
+        size: Expected size of the file in bytes
+    """
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    path = os.path.join(DOWNLOAD_DIR, os.path.basename(filename))
+    if os.path.exists(path):
+        path = os.path.join(DOWNLOAD_DIR, f"{ticket}_{os.path.basename(filename)}")
+
+    buffer = memoryview(bytearray(TRANSFER_CHUNK_SIZE))
+    received = 0
+    file = None
+
+    try:
+        with socket.create_connection((SERVER_HOST, TRANSFER_PORT), timeout=10) as data_socket:
+            data_socket.settimeout(None)
+            data_socket.sendall(f"{TRANSFER_GET} {ticket}\n".encode('utf-8'))
+            while received < size:
+                count = data_socket.recv_into(buffer)
+                if not count:
+                    break
+                if file is None:
+                    file = open(path, 'wb')
+                file.write(buffer[:count])
+                received += count
+        # An empty file has no data to wait for
+        if size == 0:
+            file = open(path, 'wb')
+    except Exception as e:
+        logger.error(f"Download of '{filename}' failed: {e}")
+    finally:
+        if file is not None:
+            file.close()
+
+    if received == size:
+        print(f"\n[FILE] Saved '{filename}' to {path}")
+        logger.info(f"Downloaded '{filename}' ({size} bytes) to {path}")
+    else:
+        print(f"\n[!] Download of '{filename}' incomplete ({received}/{size} bytes)")
+        logger.warning(f"Download of '{filename}' incomplete ({received}/{size} bytes)")
+    print("Enter message (or '/help' for commands): ", end='', flush=True)
+
+def handle_transfer_messages(message):
+    """
+    Start uploads accepted by the server and record files offered by other users.
+
+    Args:
+        message: One complete line received from the server
+    """
+    accepted = TRANSFER_ACCEPTED.match(message)
+    if accepted:
+        token = accepted.group(1)
+        path = pending_uploads.pop(token, None)
+        if path:
+            threading.Thread(target=upload_file, args=(token, path), daemon=True).start()
+
+    rejected = TRANSFER_REJECTED.match(message)
+    if rejected:
+        pending_uploads.pop(rejected.group(1), None)
+
+    incoming = INCOMING_FILE.match(message)
+    if incoming:
+        # Nothing is downloaded until the user accepts the file with /accept
+        filename, size, ticket = incoming.groups()
+        offers[ticket] = (filename, int(size))
+
+def accept_offer(message):
+    """
+    Download a file offered by another user, typed as "/accept [ticket]".
+
+    Without a ticket the most recent offer is accepted.
+
+    Args:
+        message: The command typed by the user
+    """
+    ticket = message[len('/accept'):].strip()
+    if not ticket:
+        if not offers:
+            print("[!] No files have been offered to you")
+            return
+        ticket = list(offers)[-1]
+
+    if ticket not in offers:
+        print(f"[!] No file offered with ticket {ticket}")
+        return
+
+    filename, size = offers.pop(ticket)
+    print(f"Downloading '{filename}' ({size} bytes)...")
+    threading.Thread(target=download_file, args=(ticket, filename, size), daemon=True).start()
+
 def receive_messages(client_socket):
     """
     Function to continuously receive messages from the server.
@@ -45,6 +230,10 @@ def receive_messages(client_socket):
     """
     global running, username
 
+    # A read may hold several messages or end partway through one, so transfer
+    # notices are picked out of complete lines only
+    partial_line = ""
+
     try:
         while running:
             try:
@@ -61,6 +250,13 @@ def receive_messages(client_socket):
                 # Decode the received message
                 message = data.decode('utf-8')
 
+                # Start any file uploads or downloads the server announced
+                lines = (partial_line + message).split('\n')
+                partial_line = lines.pop()
+                for line in lines:
+                    handle_transfer_messages(line)
+                message = message.rstrip('\n')
+
                 # Process username assignment/change messages
                 if "You have been assigned the username '" in message and username is None:
                     # Extract the default username from the message
@@ -167,6 +363,16 @@ def main():
                 running = False
                 break
 
+            # File transfers are set up by the client before involving the server
+            if message.startswith(('/send ', '/share ')) or message in ('/send', '/share'):
+                request_transfer(client_socket, message)
+                continue
+
+            # Accepting a file only needs a data connection, not the chat server
+            if message.startswith('/accept ') or message == '/accept':
+                accept_offer(message)
+                continue
+
             # Send the message to the server
             client_socket.send(message.encode('utf-8'))
 
@@ -13,6 +13,13 @@ HOST = '127.0.0.1'  # Standard loopback interface address (localhost)
 PORT = 5555        # Port to listen on (non-privileged ports are > 1023)
 BUFFER_SIZE = 1024  # Maximum message size
 
+# File transfer configuration
+TRANSFER_PORT = 5556             # Port for file transfer data connections
+TRANSFER_CHUNK_SIZE = 64 * 1024  # Size of the chunks files are relayed in
+TRANSFER_PUT = "PUT"             # Data connection header for uploading a file
+TRANSFER_GET = "GET"             # Data connection header for downloading a file
+DOWNLOAD_DIR = "downloads"       # Directory received files are written to
+
 # Message types
 class MessageType:
     """Enum-like class for message types to ensure consistent communication."""
@@ -22,14 +29,18 @@ class MessageType:
     COMMAND_RESULT = "CMD"  # Result of a command
     ERROR = "ERROR"         # Error message
     USER_EVENT = "EVENT"    # User joined/left events
+    FILE = "FILE"           # Incoming file transfer notification
 
 # Available commands
 COMMANDS = {
     '/help': 'Show available commands',
     '/list': 'List all connected users',
-    '/whisper': 'Send a private message to a user: /whisper <username> <message>',
+    '/whisper': 'Send a private message to a user: /whisper <username> <message> (quote the name, e.g. "bob", to message an offline user)',
     '/exit': 'Disconnect from the server',
-    '/nick': 'Change your username: /nick <new_username>'
+    '/nick': 'Change your username: /nick <new_username>',
+    '/send': 'Send a file to a user: /send <username> <path>',
+    '/share': 'Share a file with everyone in the chat: /share <path>',
+    '/accept': 'Download a file you were offered: /accept [ticket] (the latest offer if no ticket is given)'
 }
 
 def get_timestamp():
@@ -47,26 +58,29 @@ def format_message(message_type, content, sender=None, recipient=None):
         recipient: The username of the recipient (for private messages)
         
     Returns:
-        A formatted message string
+        A formatted message string, ending with a newline so that clients can tell
+        where each message ends when several arrive in one read
     """
     timestamp = get_timestamp()
     
     if message_type == MessageType.CHAT and sender:
-        return f"{timestamp} [{sender}] {content}"
+        return f"{timestamp} [{sender}] {content}\n"
     elif message_type == MessageType.PRIVATE and sender and recipient:
-        return f"{timestamp} [PRIVATE FROM {sender}] {content}"
+        return f"{timestamp} [PRIVATE FROM {sender}] {content}\n"
     elif message_type == MessageType.PRIVATE and sender:
-        return f"{timestamp} [PRIVATE TO {recipient}] {content}"
+        return f"{timestamp} [PRIVATE TO {recipient}] {content}\n"
     elif message_type == MessageType.SERVER:
-        return f"{timestamp} [SERVER] {content}"
+        return f"{timestamp} [SERVER] {content}\n"
     elif message_type == MessageType.COMMAND_RESULT:
-        return f"{timestamp} [SERVER] {content}"
+        return f"{timestamp} [SERVER] {content}\n"
     elif message_type == MessageType.ERROR:
-        return f"{timestamp} [ERROR] {content}"
+        return f"{timestamp} [ERROR] {content}\n"
     elif message_type == MessageType.USER_EVENT:
-        return f"{timestamp} [SERVER] {content}"
+        return f"{timestamp} [SERVER] {content}\n"
+    elif message_type == MessageType.FILE:
+        return f"{timestamp} [FILE] {content}\n"
     else:
-        return f"{timestamp} {content}"
+        return f"{timestamp} {content}\n"
 
 def send_message(sock, message):
     """
@@ -0,0 +1,244 @@
+"""
+TCP Chat Application - Offline Mailbox
+
+This module stores private messages sent to users who are not connected, so they can
+be delivered when the user claims the name with /nick. Messages are kept
+in a SQLite database in WAL mode, indexed by recipient. All database work happens on
+a background thread: the server queues requests without blocking its select() loop,
+and the thread writes them in batches, enforces quotas, expires old messages
+and hands fetched messages back through a socket the server loop monitors.
+"""
+import time
+import queue
+import socket
+import sqlite3
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger('server')
+
+MAILBOX_PATH = 'mailbox.db'      # SQLite database holding offline messages
+MAILBOX_QUOTA = 100              # Messages kept per user (the oldest are dropped first)
+MAILBOX_SENDER_QUOTA = 100       # Messages one sender may have waiting for all recipients together
+MAILBOX_LIMIT = 100_000          # Messages kept in the whole mailbox
+MAILBOX_TTL = 7 * 24 * 60 * 60   # Seconds an offline message is kept
+MAILBOX_BATCH_SIZE = 256         # Maximum requests written in one transaction
+MAILBOX_BATCH_DELAY = 0.05       # Seconds to gather more requests before writing a batch
+CLEANUP_INTERVAL = 60            # Seconds between removals of expired messages
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    body TEXT NOT NULL,
+    sent_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_recipient ON messages (recipient, id);
+CREATE INDEX IF NOT EXISTS messages_by_sender ON messages (sender, id);
+CREATE INDEX IF NOT EXISTS messages_by_age ON messages (sent_at);
+"""
+
+
+class OfflineMailbox:
+    """Durable per-user mailbox for private messages to users who are not connected."""
+
+    def __init__(self, path=MAILBOX_PATH):
+        self.path = path
+        self.requests = queue.Queue()  # ('store', ...) / ('fetch', ...) requests for the worker
+        self.results = deque()         # (client_socket, username, messages) fetched by the worker
+
+        # The worker writes a byte here whenever results are ready, so the server
+        # can add wakeup_socket to the sockets it passes to select()
+        self.wakeup_socket, self._notify_socket = socket.socketpair()
+        self.wakeup_socket.setblocking(0)
+        self._notify_socket.setblocking(0)
+
+        self._connection = None
+        self._thread = threading.Thread(target=self._run, name='offline-mailbox', daemon=True)
+
+    def start(self):
+        """
+        Open the database and start the background worker.
+
+        The database is opened here rather than on the worker, so a mailbox that
+        cannot be used stops the server at startup instead of failing silently.
+
+        Raises:
+            sqlite3.Error: If the database cannot be opened
+        """
+        # Only the worker uses the connection once it has started
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+        except sqlite3.Error:
+            connection.close()
+            raise
+
+        self._connection = connection
+        self._thread.start()
+
+    def store(self, recipient, sender, body, sent_at=None):
+        """
+        Queue a private message for a user who is not connected.
+
+        Args:
+            recipient: Username of the recipient
+            sender: Username of the sender
+            body: The message text
+            sent_at: When the message was sent (defaults to now)
+
+        Returns:
+            True if the message was queued, False if the mailbox is not running
+        """
+        if not self._thread.is_alive():
+            return False
+        self.requests.put(('store', recipient, sender, body, sent_at or time.time()))
+        return True
+
+    def fetch(self, username, client_socket):
+        """
+        Ask for a user's offline messages to be removed from the mailbox.
+
+        The messages are returned later by completed(), together with the client
+        socket they were fetched for.
+
+        Args:
+            username: The username whose messages should be delivered
+            client_socket: The socket of the client that now holds the username
+        """
+        self.requests.put(('fetch', username, client_socket))
+
+    def completed(self):
+        """
+        Get the fetches the worker has finished since the last call.
+
+        Returns:
+            A list of (client_socket, username, messages) tuples, where messages is a
+            list of (sender, body, sent_at) tuples in the order they were sent
+        """
+        try:
+            while self.wakeup_socket.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+        results = []
+        while self.results:
+            results.append(self.results.popleft())
+        return results
+
+    def close(self):
+        """Write any queued messages and stop the worker."""
+        if self._thread.is_alive():
+            self.requests.put(None)
+            self._thread.join()
+        self.wakeup_socket.close()
+        self._notify_socket.close()
+
+    def _run(self):
+        """Worker loop: apply queued requests in batches and expire old messages."""
+        connection = self._connection
+        next_cleanup = 0
+        running = True
+
+        while running:
+            try:
+                first = self.requests.get(timeout=max(next_cleanup - time.monotonic(), 0))
+            except queue.Empty:
+                first = ()
+
+            batch = [first] if first != () else []
+            deadline = time.monotonic() + MAILBOX_BATCH_DELAY
+            while batch and batch[-1] is not None and len(batch) < MAILBOX_BATCH_SIZE:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                running = False
+
+            try:
+                if batch:
+                    self._apply(connection, batch)
+                if time.monotonic() >= next_cleanup or not running:
+                    self._expire(connection)
+                    next_cleanup = time.monotonic() + CLEANUP_INTERVAL
+            except Exception as e:
+                # Keep the worker alive; only this batch is lost
+                logger.error(f"Offline mailbox error: {e}")
+
+        connection.close()
+
+    def _apply(self, connection, batch):
+        """Write a batch of requests in a single transaction and publish any fetches."""
+        fetched = []
+        with connection:
+            stored = [request[1:] for request in batch if request[0] == 'store']
+            if stored:
+                connection.executemany(
+                    'INSERT INTO messages (recipient, sender, body, sent_at) VALUES (?, ?, ?, ?)',
+                    stored
+                )
+                # Enforce quotas by dropping the oldest messages beyond the limit
+                for recipient in {request[0] for request in stored}:
+                    connection.execute(
+                        'DELETE FROM messages WHERE recipient = ? AND id NOT IN '
+                        '(SELECT id FROM messages WHERE recipient = ? ORDER BY id DESC LIMIT ?)',
+                        (recipient, recipient, MAILBOX_QUOTA)
+                    )
+                # Writing to many different names must not grow the mailbox without bound
+                for sender in {request[1] for request in stored}:
+                    connection.execute(
+                        'DELETE FROM messages WHERE sender = ? AND id NOT IN '
+                        '(SELECT id FROM messages WHERE sender = ? ORDER BY id DESC LIMIT ?)',
+                        (sender, sender, MAILBOX_SENDER_QUOTA)
+                    )
+                connection.execute(
+                    'DELETE FROM messages WHERE id <= '
+                    '(SELECT id FROM messages ORDER BY id DESC LIMIT 1 OFFSET ?)',
+                    (MAILBOX_LIMIT,)
+                )
+
+            cutoff = time.time() - MAILBOX_TTL
+            for request in batch:
+                if request[0] != 'fetch':
+                    continue
+                _, username, client_socket = request
+                rows = connection.execute(
+                    'SELECT id, sender, body, sent_at FROM messages WHERE recipient = ? ORDER BY id',
+                    (username,)
+                ).fetchall()
+                if rows:
+                    connection.execute(
+                        'DELETE FROM messages WHERE recipient = ? AND id <= ?',
+                        (username, rows[-1][0])
+                    )
+                messages = [row[1:] for row in rows if row[3] >= cutoff]
+                if messages:
+                    fetched.append((client_socket, username, messages))
+
+        if stored:
+            logger.debug(f"Offline mailbox: stored {len(stored)} message(s)")
+        if fetched:
+            self.results.extend(fetched)
+            try:
+                self._notify_socket.send(b'\0')
+            except BlockingIOError:
+                # The server has not drained earlier wakeups yet; it will see these results too
+                pass
+
+    def _expire(self, connection):
+        """Remove messages older than MAILBOX_TTL."""
+        with connection:
+            expired = connection.execute(
+                'DELETE FROM messages WHERE sent_at < ?',
+                (time.time() - MAILBOX_TTL,)
+            ).rowcount
+        if expired:
+            logger.info(f"Offline mailbox: expired {expired} message(s)")
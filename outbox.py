@@ -0,0 +1,154 @@
+"""
+TCP Chat Application - Outbound Queues
+
+This module implements the per-client outbound queues used by the server. Messages
+are sent straight away while a client keeps up. When its socket stops accepting data
+they wait in one queue per priority class, are drained in priority order as the socket
+becomes writable again, and the lowest-priority backlog is dropped first (and later
+summarised to the client) once the queue is full.
+"""
+from collections import deque
+
+from common import MessageType, format_message
+
+OUTBOX_LIMIT = 64 * 1024    # Bytes queued per client before messages are dropped
+URGENT_LIMIT = 256 * 1024   # Bytes of never-dropped messages queued before the client is disconnected
+CLIENT_SNDBUF = 32 * 1024   # Kernel send buffer per client, kept small so backlog builds up here
+
+# Delivery priority of each message type (lower numbers are sent first and dropped last)
+MESSAGE_PRIORITY = {
+    MessageType.ERROR: 0,
+    MessageType.COMMAND_RESULT: 0,
+    MessageType.SERVER: 0,
+    MessageType.FILE: 0,
+    MessageType.PRIVATE: 1,
+    MessageType.CHAT: 2,
+    MessageType.USER_EVENT: 3,
+}
+PRIORITY_LEVELS = max(MESSAGE_PRIORITY.values()) + 1
+
+# How dropped messages are described in the summary sent to the client
+DROPPED_LABELS = {
+    MessageType.PRIVATE: "private message(s)",
+    MessageType.CHAT: "chat message(s)",
+    MessageType.USER_EVENT: "user event(s)",
+}
+
+
+class Outbox:
+    """Outbound messages waiting to be sent to one client, queued by priority class."""
+
+    def __init__(self):
+        self.queues = [deque() for _ in range(PRIORITY_LEVELS)]  # (message_type, data) per class
+        self.partial = None  # Remainder of a message the socket only partly accepted
+        self.size = 0        # Bytes waiting in the queues
+        self.urgent = 0      # Bytes waiting in the highest priority queue
+        self.overflowed = False  # Set when the client should be disconnected
+        self.dropped = {}    # Message type -> number of messages dropped since the last summary
+
+    def pending(self):
+        """Check whether any data is waiting to be sent."""
+        return self.partial is not None or self.size > 0
+
+    def put(self, message_type, data):
+        """
+        Queue an encoded message, dropping lower-priority backlog if the queue is full.
+
+        Messages in the highest priority class (errors, command results, server
+        notices and file offers) are never dropped; they answer the client's own
+        commands or carry the only copy of a download ticket. If more than
+        URGENT_LIMIT bytes of them pile up, the client is not reading them, so the
+        outbox is marked as overflowed and the server disconnects it. Other messages first evict the oldest messages of lower classes, then
+        the oldest of their own class.
+
+        Args:
+            message_type: Type of message (from MessageType class)
+            data: The encoded message
+
+        Returns:
+            True if the message was queued, False if it was dropped
+        """
+        priority = MESSAGE_PRIORITY.get(message_type, PRIORITY_LEVELS - 1)
+
+        if self.overflowed:
+            return False
+
+        if priority == 0:
+            if self.urgent + len(data) > URGENT_LIMIT:
+                self.overflowed = True
+                return False
+            self.urgent += len(data)
+
+        while priority > 0 and self.size + len(data) > OUTBOX_LIMIT:
+            victim = next(
+                (level for level in range(PRIORITY_LEVELS - 1, priority - 1, -1) if self.queues[level]),
+                None
+            )
+            if victim is None:
+                self._count_drop(message_type)
+                return False
+            dropped_type, dropped_data = self.queues[victim].popleft()
+            self.size -= len(dropped_data)
+            self._count_drop(dropped_type)
+
+        self.queues[priority].append((message_type, data))
+        self.size += len(data)
+        return True
+
+    def flush(self, sock):
+        """
+        Send queued messages in priority order until the socket would block.
+
+        Each message is passed to its own send() call, as messages were before
+        queueing was added, and a partly sent message is finished before any other.
+
+        Args:
+            sock: The client's socket object
+
+        Returns:
+            True if the socket is still usable, False if sending failed
+        """
+        while True:
+            if self.partial is None:
+                message = self._next()
+                if message is None:
+                    return True
+                self.partial = memoryview(message)
+
+            try:
+                sent = sock.send(self.partial)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+
+            self.partial = self.partial[sent:] if sent < len(self.partial) else None
+            if self.partial is not None:
+                return True
+
+    def _next(self):
+        """Get the next message to send, queueing a drop summary once the backlog clears."""
+        for priority, queue in enumerate(self.queues):
+            if queue:
+                _, data = queue.popleft()
+                self.size -= len(data)
+                if priority == 0:
+                    self.urgent -= len(data)
+                return data
+
+        if self.dropped:
+            missed = ", ".join(
+                f"{count} {DROPPED_LABELS.get(message_type, 'message(s)')}"
+                for message_type, count in self.dropped.items()
+            )
+            self.dropped = {}
+            return format_message(
+                MessageType.SERVER,
+                f"Your connection fell behind; {missed} were dropped."
+            ).encode('utf-8')
+
+        return None
+
+    def _count_drop(self, message_type):
+        """Record a dropped message for the next summary."""
+        self.dropped[message_type] = self.dropped.get(message_type, 0) + 1
@@ -0,0 +1,279 @@
+"""
+TCP Chat Application - Traffic Replay
+
+This module re-drives a trace recorded with `server.py --capture` against a running
+server. Connections are opened, fed and closed exactly as in the trace, at the
+recorded pace, N times faster, or as fast as possible, so real traffic can be
+reproduced offline. It reports throughput and command response latency, and can
+save the report and compare a later run (for example against another server build)
+with it.
+"""
+import re
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import selectors
+
+# Import common utilities and constants
+from common import HOST, PORT
+from capture import read_trace, EVENT_OPEN, EVENT_DATA, EVENT_CLOSE
+
+# Configure replay logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [REPLAY] %(message)s',
+    datefmt='%H:%M:%S'
+)
+logger = logging.getLogger('replay')
+
+DRAIN_TIMEOUT = 2.0  # Seconds to wait for outstanding command responses after the last record
+REPLY_TIMEOUT = 1.0  # Seconds a maximum speed replay waits for a reply before sending more on a connection
+FRAME_GAP = 0.01     # Minimum seconds between frames sent on one connection
+
+# Lines that answer a client's own command: server notices, errors and the copy of
+# a whisper sent back to its sender. Chat from other users does not match, and
+# user joined/left/renamed events are skipped even though they look like notices
+REPLY = re.compile(rb"\[\d\d:\d\d:\d\d\] \[(SERVER|ERROR|PRIVATE TO [^\]]*)\] ")
+USER_EVENT = re.compile(rb"User .+ (has joined the chat|has left the chat|is now known as )")
+
+# Report fields in display order: (key, label, unit)
+REPORT_FIELDS = [
+    ('frames', 'Frames sent', ''),
+    ('bytes_sent', 'Bytes sent', 'B'),
+    ('bytes_received', 'Bytes received', 'B'),
+    ('trace_duration', 'Recorded duration', 's'),
+    ('duration', 'Replay duration', 's'),
+    ('frames_per_second', 'Throughput', 'frames/s'),
+    ('bytes_per_second', 'Throughput', 'B/s'),
+    ('commands_sent', 'Commands sent', ''),
+    ('commands', 'Commands answered', ''),
+    ('latency_p50_ms', 'Command latency p50', 'ms'),
+    ('latency_p95_ms', 'Command latency p95', 'ms'),
+    ('latency_max_ms', 'Command latency max', 'ms'),
+    ('max_lag_ms', 'Max schedule lag', 'ms'),
+]
+
+def percentile(values, fraction):
+    """Get a percentile of a list of numbers (0 if the list is empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[round(fraction * (len(ordered) - 1))]
+
+def is_reply(line):
+    """Check whether a line received from the server answers a command."""
+    match = REPLY.match(line)
+    return match is not None and USER_EVENT.match(line, match.end()) is None
+
+def replay(records, host, port, speed):
+    """
+    Replay trace records against a server.
+
+    Command latency is the time from sending a frame that starts with '/' until
+    the reply arrives on the same connection (see is_reply); chat and user events
+    that arrive in the meantime do not count. A connection that closes while
+    it is still waiting for a reply stays open until the reply arrives or the
+    drain phase ends, so fast replays still measure the last commands.
+
+    The server handles whatever one recv() returns as one message, so frames must
+    reach it separately. Frames on one connection are therefore sent at least
+    FRAME_GAP apart with Nagle's algorithm disabled, and at maximum speed a
+    connection also waits for the reply to its last command before sending its
+    next frame. A server that falls more than FRAME_GAP behind can still read two
+    chat frames at once; the server log shows them as one message.
+
+    Args:
+        records: List of (timestamp, connection_id, event, payload) trace records
+        host: Server host
+        port: Server port
+        speed: Replay speed multiplier (1 for the recorded pace, 0 for maximum speed)
+
+    Returns:
+        A report dictionary with the fields listed in REPORT_FIELDS
+    """
+    selector = selectors.DefaultSelector()
+    connections = {}  # Connection ID from the trace -> socket
+    awaiting = {}     # Socket -> time its last command was sent
+    closing = set()   # Sockets closed in the trace that are still waiting for a reply
+    partial = {}      # Socket -> incomplete last line received from the server
+    last_sent = {}    # Socket -> time its last frame was sent
+    latencies = []
+    stats = {'frames': 0, 'bytes_sent': 0, 'bytes_received': 0, 'commands_sent': 0}
+    max_lag = 0.0
+
+    def close(sock):
+        """Stop monitoring a socket and close it."""
+        if sock in selector.get_map():
+            selector.unregister(sock)
+        awaiting.pop(sock, None)
+        closing.discard(sock)
+        partial.pop(sock, None)
+        last_sent.pop(sock, None)
+        sock.close()
+
+    def read_responses(timeout):
+        """Read whatever the server has sent, waiting up to timeout seconds."""
+        for key, _ in selector.select(timeout):
+            sock = key.fileobj
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                data = b''
+
+            if not data:
+                selector.unregister(sock)
+                awaiting.pop(sock, None)
+                continue
+
+            stats['bytes_received'] += len(data)
+
+            # The server ends every message with a newline
+            lines = (partial.pop(sock, b'') + data).split(b'\n')
+            partial[sock] = lines.pop()
+            if sock in awaiting and any(is_reply(line) for line in lines):
+                latencies.append(time.perf_counter() - awaiting.pop(sock))
+                if sock in closing:
+                    close(sock)
+
+    started = time.perf_counter()
+    for timestamp, connection_id, event, payload in records:
+        if speed:
+            due = started + timestamp / speed
+            while True:
+                wait = due - time.perf_counter()
+                if wait <= 0:
+                    break
+                read_responses(wait)
+            max_lag = max(max_lag, time.perf_counter() - due)
+        else:
+            read_responses(0)
+
+        if event == EVENT_OPEN:
+            sock = socket.create_connection((host, port), timeout=10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections[connection_id] = sock
+            selector.register(sock, selectors.EVENT_READ)
+
+        elif event == EVENT_DATA and connection_id in connections:
+            sock = connections[connection_id]
+            if not speed:
+                deadline = time.perf_counter() + REPLY_TIMEOUT
+                while sock in awaiting and time.perf_counter() < deadline:
+                    read_responses(deadline - time.perf_counter())
+            gap_ends = last_sent.get(sock, 0) + FRAME_GAP
+            while time.perf_counter() < gap_ends:
+                read_responses(gap_ends - time.perf_counter())
+            try:
+                sock.sendall(payload)
+            except OSError as e:
+                logger.error(f"Connection {connection_id}: send failed: {e}")
+                continue
+            last_sent[sock] = time.perf_counter()
+            stats['frames'] += 1
+            stats['bytes_sent'] += len(payload)
+            if payload.startswith(b'/'):
+                awaiting[sock] = time.perf_counter()
+                stats['commands_sent'] += 1
+
+        elif event == EVENT_CLOSE and connection_id in connections:
+            sock = connections.pop(connection_id)
+            if sock in awaiting:
+                closing.add(sock)
+            else:
+                close(sock)
+
+    finished = time.perf_counter()
+
+    # Give the server a moment to answer the last commands
+    while awaiting and time.perf_counter() < finished + DRAIN_TIMEOUT:
+        read_responses(finished + DRAIN_TIMEOUT - time.perf_counter())
+
+    for sock in list(connections.values()) + list(closing):
+        close(sock)
+    selector.close()
+
+    duration = max(finished - started, 1e-9)
+    return {
+        **stats,
+        'trace_duration': records[-1][0] if records else 0.0,
+        'duration': duration,
+        'frames_per_second': stats['frames'] / duration,
+        'bytes_per_second': stats['bytes_sent'] / duration,
+        'commands': len(latencies),
+        'latency_p50_ms': percentile(latencies, 0.50) * 1000,
+        'latency_p95_ms': percentile(latencies, 0.95) * 1000,
+        'latency_max_ms': max(latencies, default=0.0) * 1000,
+        'max_lag_ms': max_lag * 1000,
+    }
+
+def print_report(report, baseline=None):
+    """
+    Print a replay report, with the change from a baseline report if given.
+
+    Args:
+        report: The report returned by replay()
+        baseline: An earlier report to compare with (optional)
+    """
+    print("\n--- Replay Report ---")
+    for key, label, unit in REPORT_FIELDS:
+        value = report[key]
+        number = f"{value:>14,.2f}" if isinstance(value, float) else f"{value:>14,}"
+        line = f"  {label:<22} {number} {unit}".rstrip()
+        if baseline and key in baseline:
+            previous = baseline[key]
+            if previous:
+                line += f"  ({(value - previous) / previous * 100:+.1f}% vs baseline)"
+            else:
+                line += f"  (baseline {previous})"
+        print(line)
+    print("---------------------")
+
+def main():
+    """Main function to run the replay tool."""
+    parser = argparse.ArgumentParser(description="Replay a chat traffic trace against a server")
+    parser.add_argument('trace', help="trace file recorded with server.py --capture")
+    parser.add_argument('--host', default=HOST, help=f"server host (default {HOST})")
+    parser.add_argument('--port', type=int, default=PORT, help=f"server port (default {PORT})")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed multiplier (default 1)")
+    parser.add_argument('--max', action='store_true', help="replay as fast as possible")
+    parser.add_argument('--save', metavar='PATH', help="save the report as JSON")
+    parser.add_argument('--baseline', metavar='PATH', help="compare with a report saved earlier")
+    args = parser.parse_args()
+
+    if args.speed <= 0 and not args.max:
+        parser.error("--speed must be positive (use --max for maximum speed)")
+
+    try:
+        records = list(read_trace(args.trace))
+        baseline = None
+        if args.baseline:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.error(f"Error: {e}")
+        return 1
+
+    speed = 0 if args.max else args.speed
+    logger.info(f"Replaying {len(records)} records against {args.host}:{args.port} "
+                f"at {'maximum speed' if not speed else f'{speed:g}x'}")
+
+    try:
+        report = replay(records, args.host, args.port, speed)
+    except ConnectionRefusedError:
+        logger.error(f"Connection refused. Make sure the server is running at {args.host}:{args.port}")
+        return 1
+
+    print_report(report, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(report, file, indent=2)
+        logger.info(f"Report saved to {args.save}")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,15 +4,24 @@ TCP Chat Application - Server
 This module implements the server side of a TCP-based chat application using select-based I/O multiplexing.
 It includes enhanced features like username registration, timestamped messages, and command support.
 """
+import os
+import re
+import time
 import socket
 import select
+import sqlite3
 import logging
+import argparse
 
 # Import common utilities and constants
 from common import (
-    HOST, PORT, BUFFER_SIZE, COMMANDS,
+    HOST, PORT, TRANSFER_PORT, BUFFER_SIZE, COMMANDS,
     get_timestamp, format_message, MessageType
 )
+from transfer import TransferRelay, ACCEPT_TIMEOUT
+from outbox import Outbox, CLIENT_SNDBUF
+from offline import OfflineMailbox
+from capture import TraceWriter
 
 # Configure server logging
 logging.basicConfig(
@@ -26,9 +35,21 @@ logger = logging.getLogger('server')
 # Key: socket object, Value: (address, username)
 clients = {}
 
+# Outbound message queues for each client, drained in priority order
+# Key: socket object, Value: Outbox
+outboxes = {}
+
 # Counter for assigning default usernames
 user_counter = 0
 
+# Default usernames ("User 1", "User 2", ...) start again from 1 whenever the
+# server restarts, so the offline mailbox never stores or delivers mail for them
+DEFAULT_USERNAME = re.compile(r'User \d+')
+
+def is_default_username(username):
+    """Check whether a username looks like one the server assigns automatically."""
+    return DEFAULT_USERNAME.fullmatch(username) is not None
+
 def get_username(client_socket):
     """Get the username for a client socket."""
     if client_socket in clients and clients[client_socket][1]:
@@ -37,6 +58,62 @@ def get_username(client_socket):
         client_address = clients[client_socket][0]
         return f"{client_address[0]}:{client_address[1]}"
 
+def find_client_socket(username):
+    """Get the socket of the connected client with the given username, or None."""
+    for sock, (_, user) in clients.items():
+        if user == username:
+            return sock
+    return None
+
+def send_to(client_socket, message_type, message):
+    """
+    Queue a formatted message for a client and send as much as its socket accepts.
+
+    Messages that cannot be sent right away wait in the client's outbox and are
+    delivered in priority order once the socket becomes writable again.
+
+    Args:
+        client_socket: The client's socket object
+        message_type: Type of message (from MessageType class)
+        message: The formatted message
+
+    Returns:
+        True if the message was sent or queued, False otherwise
+    """
+    outbox = outboxes.get(client_socket)
+    if outbox is None:
+        return False
+
+    if not outbox.put(message_type, message.encode('utf-8')):
+        return False
+
+    if not outbox.flush(client_socket):
+        # If sending fails, the client might be disconnected
+        # We'll handle this in the main loop
+        logger.error(f"Failed to send to {get_username(client_socket)}")
+        return False
+    return True
+
+def send_notice(client_socket, message_type, content):
+    """
+    Send a server notice to a client if it is still connected.
+
+    Args:
+        client_socket: The client's socket object
+        message_type: Type of message (from MessageType class)
+        content: The message content
+    """
+    send_to(client_socket, message_type, format_message(message_type, content))
+
+# File transfers in progress, relayed over separate data connections
+relay = TransferRelay(notify=send_notice)
+
+# Private messages waiting for users who are not connected
+mailbox = OfflineMailbox()
+
+# Trace of inbound traffic, when the server runs in capture mode
+capture = None
+
 def broadcast_message(message, sender_socket=None, message_type=MessageType.CHAT):
     """
     Broadcast a message to all connected clients except the sender.
@@ -56,68 +133,183 @@ def broadcast_message(message, sender_socket=None, message_type=MessageType.CHAT
     for client_socket in clients:
         # Don't send the message back to the sender
         if client_socket != sender_socket:
-            try:
-                client_socket.send(formatted_message.encode('utf-8'))
-            except Exception as e:
-                logger.error(f"Failed to send to {get_username(client_socket)}: {e}")
-                # If sending fails, the client might be disconnected
-                # We'll handle this in the main loop
-                pass
-
-def send_private_message(message, sender_socket, recipient_username):
+            send_to(client_socket, message_type, formatted_message)
+
+def send_private_message(message, sender_socket, recipient_username, allow_offline=False):
     """
     Send a private message to a specific user.
 
+    If the recipient is not connected and allow_offline is set, the message is
+    kept in the offline mailbox and delivered when someone takes the username
+    with /nick.
+
     Args:
         message: The message to send
         sender_socket: The socket of the client who sent the message
         recipient_username: The username of the recipient
+        allow_offline: Whether the recipient name was given unambiguously, so the
+            message may be stored if they are not connected
 
     Returns:
-        True if the message was sent, False otherwise
+        True if the message was sent or stored, False otherwise
     """
     sender_username = get_username(sender_socket)
 
     # Find the recipient socket
-    recipient_socket = None
-    for sock, (_, username) in clients.items():
-        if username == recipient_username:
-            recipient_socket = sock
-            break
+    recipient_socket = find_client_socket(recipient_username)
 
     if recipient_socket:
-        try:
-            # Format and send the private message to recipient
-            to_recipient = format_message(
-                MessageType.PRIVATE,
-                message,
-                sender=sender_username,
-                recipient=recipient_username
-            )
-            recipient_socket.send(to_recipient.encode('utf-8'))
-
-            # Also send a confirmation to the sender
-            to_sender = format_message(
-                MessageType.PRIVATE,
-                message,
-                sender=sender_username,
-                recipient=recipient_username
+        # Format and send the private message to recipient
+        to_recipient = format_message(
+            MessageType.PRIVATE,
+            message,
+            sender=sender_username,
+            recipient=recipient_username
+        )
+        if not send_to(recipient_socket, MessageType.PRIVATE, to_recipient):
+            logger.error(f"Failed to send private message: {sender_username} -> {recipient_username}")
+            return False
+
+        # Also send a confirmation to the sender
+        to_sender = format_message(
+            MessageType.PRIVATE,
+            message,
+            sender=sender_username,
+            recipient=recipient_username
+        )
+        send_to(sender_socket, MessageType.PRIVATE, to_sender)
+
+        logger.info(f"Private message: {sender_username} -> {recipient_username}")
+        return True
+    elif not allow_offline:
+        # Without quotes we cannot tell where an unknown name ends and the message begins
+        send_notice(
+            sender_socket,
+            MessageType.ERROR,
+            f"User '{recipient_username}' not found. To leave a message for an offline user, "
+            f"put the name in quotes: /whisper \"<username>\" <message>"
+        )
+        return False
+    elif is_default_username(recipient_username):
+        # Default usernames are handed out again after a restart
+        send_notice(
+            sender_socket,
+            MessageType.ERROR,
+            f"User '{recipient_username}' is not online. Messages can only be left for usernames chosen with /nick."
+        )
+        return False
+    else:
+        # User not connected - keep the message until they are
+        if not mailbox.store(recipient_username, sender_username, message):
+            send_notice(
+                sender_socket,
+                MessageType.ERROR,
+                f"User '{recipient_username}' is not online and messages cannot be left right now."
             )
-            sender_socket.send(to_sender.encode('utf-8'))
+            logger.error(f"Offline mailbox is not running; dropped message {sender_username} -> {recipient_username}")
+            return False
+        send_notice(
+            sender_socket,
+            MessageType.SERVER,
+            f"User '{recipient_username}' is not online. Your message will be delivered when they take the name with /nick."
+        )
+        logger.info(f"Private message stored for offline user: {sender_username} -> {recipient_username}")
+        return True
 
-            logger.info(f"Private message: {sender_username} -> {recipient_username}")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to send private message: {e}")
+def deliver_offline_messages(client_socket, username, messages):
+    """
+    Deliver private messages fetched from the offline mailbox.
+
+    Args:
+        client_socket: The socket of the client the messages were fetched for
+        username: The username the messages were sent to
+        messages: List of (sender, body, sent_at) tuples
+    """
+    # The client may have disconnected or changed its name while the messages
+    # were being fetched - put them back for whoever holds the name next
+    if client_socket not in clients or clients[client_socket][1] != username:
+        for sender, body, sent_at in messages:
+            mailbox.store(username, sender, body, sent_at)
+        return
+
+    send_notice(
+        client_socket,
+        MessageType.SERVER,
+        f"You have {len(messages)} private message(s) sent while you were offline:"
+    )
+    for sender, body, sent_at in messages:
+        sent = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sent_at))
+        send_to(client_socket, MessageType.PRIVATE, format_message(
+            MessageType.PRIVATE,
+            f"(sent {sent}) {body}",
+            sender=sender,
+            recipient=username
+        ))
+
+    logger.info(f"Delivered {len(messages)} offline message(s) to {username}")
+
+def start_transfer(client_socket, cmd, args):
+    """
+    Register a file transfer requested by a client.
+
+    The client sends "/send <token> <size> <filename> <username>" or
+    "/share <token> <size> <filename>" and then uploads the file over a data
+    connection once the transfer has been accepted. Every recipient is told
+    the ticket it should use to download the file.
+
+    Args:
+        client_socket: The socket of the client sending the file
+        cmd: The command (/send or /share)
+        args: The command arguments
+
+    Returns:
+        True if the transfer was accepted, False otherwise
+    """
+    parts = args.split(' ', 3 if cmd == '/send' else 2)
+    expected = 4 if cmd == '/send' else 3
+    if len(parts) != expected or not parts[1].isdigit():
+        send_notice(client_socket, MessageType.ERROR, f"Usage: {COMMANDS[cmd].split(': ', 1)[1]}")
+        return False
+
+    token, size, filename = parts[0], int(parts[1]), os.path.basename(parts[2])
+    if token in relay.transfers or not filename:
+        send_notice(client_socket, MessageType.ERROR, f"Transfer {token} rejected: invalid transfer.")
+        return False
+
+    if cmd == '/send':
+        recipient_username = parts[3]
+        recipient_socket = find_client_socket(recipient_username)
+        if recipient_socket is None:
+            send_notice(client_socket, MessageType.ERROR, f"Transfer {token} rejected: User '{recipient_username}' not found.")
             return False
+        if recipient_socket is client_socket:
+            send_notice(client_socket, MessageType.ERROR, f"Transfer {token} rejected: you cannot send a file to yourself.")
+            return False
+        recipients = [recipient_socket]
+        target = recipient_username
     else:
-        # User not found
-        error_msg = format_message(
-            MessageType.ERROR,
-            f"User '{recipient_username}' not found."
+        recipients = [sock for sock in clients if sock is not client_socket]
+        if not recipients:
+            send_notice(client_socket, MessageType.ERROR, f"Transfer {token} rejected: nobody else is connected.")
+            return False
+        target = f"{len(recipients)} user(s)"
+
+    sender_username = get_username(client_socket)
+    tickets = relay.create(token, client_socket, filename, size, recipients)
+    for recipient_socket, ticket in tickets.items():
+        send_notice(
+            recipient_socket,
+            MessageType.FILE,
+            f"Incoming file '{filename}' ({size} bytes) from {sender_username} [transfer {ticket}]. "
+            f"Type /accept within {ACCEPT_TIMEOUT} seconds to download it."
         )
-        sender_socket.send(error_msg.encode('utf-8'))
-        return False
+
+    send_notice(
+        client_socket,
+        MessageType.COMMAND_RESULT,
+        f"Transfer {token} accepted: sending '{filename}' ({size} bytes) to {target}."
+    )
+    return True
 
 def handle_command(client_socket, command):
     """
@@ -144,7 +336,7 @@ def handle_command(client_socket, command):
         help_text = "Available commands:\n"
         for cmd, desc in COMMANDS.items():
             help_text += f"  {cmd} - {desc}\n"
-        client_socket.send(format_message(MessageType.COMMAND_RESULT, help_text).encode('utf-8'))
+        send_notice(client_socket, MessageType.COMMAND_RESULT, help_text.rstrip('\n'))
 
     elif cmd == '/list':
         # List all connected users
@@ -152,22 +344,32 @@ def handle_command(client_socket, command):
         for _, (_, user) in enumerate(clients.values()):
             if user:  # Only list users who have registered a username
                 user_list += f"  - {user}\n"
-        client_socket.send(format_message(MessageType.COMMAND_RESULT, user_list).encode('utf-8'))
+        send_notice(client_socket, MessageType.COMMAND_RESULT, user_list.rstrip('\n'))
 
     elif cmd == '/whisper':
         # Send a private message
         # First, check if we have enough arguments
         if ' ' not in args:
-            client_socket.send(format_message(
+            send_notice(
+                client_socket,
                 MessageType.ERROR,
                 "Usage: /whisper <username> <message>"
-            ).encode('utf-8'))
+            )
             return True
 
-        # Special handling for usernames with spaces (like "User 2")
-        # Try to find a matching username from our clients dictionary
         recipient = None
         message = None
+        quoted = False
+
+        # A quoted name ("User 2" or "alice") is taken exactly, even if nobody has it yet
+        closing = args.find('" ', 1)
+        if args.startswith('"') and closing > 1:
+            recipient = args[1:closing]
+            message = args[closing + 2:]
+            quoted = True
+
+        # Special handling for usernames with spaces (like "User 2")
+        # Try to find a matching username from our clients dictionary
 
         # Get all usernames
         all_usernames = [username for _, username in clients.values() if username]
@@ -177,7 +379,7 @@ def handle_command(client_socket, command):
 
         # Try to find a matching username at the beginning of args
         for username in all_usernames:
-            if args.startswith(username + ' '):
+            if recipient is None and args.startswith(username + ' '):
                 recipient = username
                 message = args[len(username) + 1:]  # +1 for the space
                 break
@@ -190,30 +392,37 @@ def handle_command(client_socket, command):
 
         # Send the private message
         if message:
-            send_private_message(message, client_socket, recipient)
+            send_private_message(message, client_socket, recipient, allow_offline=quoted)
         else:
-            client_socket.send(format_message(
+            send_notice(
+                client_socket,
                 MessageType.ERROR,
                 "Usage: /whisper <username> <message>"
-            ).encode('utf-8'))
+            )
             return True
 
+    elif cmd in ('/send', '/share'):
+        # Start a file transfer - the file itself arrives on a data connection
+        start_transfer(client_socket, cmd, args)
+
     elif cmd == '/exit':
         # Client wants to exit - this will be handled in the main loop
         # Just send a confirmation
-        client_socket.send(format_message(
+        send_notice(
+            client_socket,
             MessageType.SERVER,
             "Disconnecting..."
-        ).encode('utf-8'))
+        )
         return False  # Let the client close the connection
 
     elif cmd == '/nick':
         # Change username
         if not args:
-            client_socket.send(format_message(
+            send_notice(
+                client_socket,
                 MessageType.ERROR,
                 "Usage: /nick <new_username>"
-            ).encode('utf-8'))
+            )
             return True
 
         new_username = args.strip()
@@ -221,10 +430,11 @@ def handle_command(client_socket, command):
         # Check if username is already taken
         for _, (_, user) in clients.items():
             if user == new_username:
-                client_socket.send(format_message(
+                send_notice(
+                    client_socket,
                     MessageType.ERROR,
                     f"Username '{new_username}' is already taken."
-                ).encode('utf-8'))
+                )
                 return True
 
         # Update username
@@ -232,10 +442,11 @@ def handle_command(client_socket, command):
         clients[client_socket] = (clients[client_socket][0], new_username)
 
         # Notify the client
-        client_socket.send(format_message(
+        send_notice(
+            client_socket,
             MessageType.SERVER,
             f"Your username has been changed to '{new_username}'."
-        ).encode('utf-8'))
+        )
 
         # Notify other clients
         if old_username:
@@ -243,12 +454,17 @@ def handle_command(client_socket, command):
         else:
             broadcast_message(f"User {username} is now known as '{new_username}'.", client_socket, MessageType.USER_EVENT)
 
+        # Deliver private messages sent to the new username while it was not in use
+        if not is_default_username(new_username):
+            mailbox.fetch(new_username, client_socket)
+
     else:
         # Unknown command
-        client_socket.send(format_message(
+        send_notice(
+            client_socket,
             MessageType.ERROR,
             f"Unknown command: {cmd}. Type /help for available commands."
-        ).encode('utf-8'))
+        )
 
     return True
 
@@ -270,6 +486,10 @@ def handle_new_connection(server_socket):
     # Set the socket to non-blocking mode
     client_socket.setblocking(0)
 
+    # Limit the kernel send buffer so that a backed-up client's messages wait
+    # in its outbox, where they can be prioritised, instead of in the kernel
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SNDBUF)
+
     # Increment user counter and assign default username
     user_counter += 1
     default_username = f"User {user_counter}"
@@ -277,6 +497,9 @@ def handle_new_connection(server_socket):
     # Store client information with default username
     client_id = f"{client_address[0]}:{client_address[1]}"
     clients[client_socket] = (client_address, default_username)
+    outboxes[client_socket] = Outbox()
+    if capture:
+        capture.opened(client_socket)
 
     # Log the new connection on server side only
     logger.info(f"Accepted connection from {client_id} (assigned username: {default_username})")
@@ -286,14 +509,14 @@ def handle_new_connection(server_socket):
         MessageType.SERVER,
         f"Welcome to the TCP Chat Server! There are {len(clients)} clients connected."
     )
-    client_socket.send(welcome_message.encode('utf-8'))
+    send_to(client_socket, MessageType.SERVER, welcome_message)
 
     # Inform the user of their default username and how to change it
     username_message = format_message(
         MessageType.SERVER,
         f"You have been assigned the username '{default_username}'. You can change it using the /nick command."
     )
-    client_socket.send(username_message.encode('utf-8'))
+    send_to(client_socket, MessageType.SERVER, username_message)
 
     # Notify other clients about the new user
     broadcast_message(
@@ -321,6 +544,8 @@ def handle_client_message(client_socket):
     try:
         # Receive data from the client
         data = client_socket.recv(BUFFER_SIZE)
+        if capture:
+            capture.received(client_socket, data)
 
         # If no data is received, the client has disconnected
         if not data:
@@ -329,6 +554,10 @@ def handle_client_message(client_socket):
         # Decode the received data
         message = data.decode('utf-8').strip()
 
+        # Keep each message on one line; text after a newline would otherwise
+        # reach other clients looking like a separate message from the server
+        message = message.replace('\r', ' ').replace('\n', ' ')
+
         # Check if this is a command
         if message.startswith('/'):
             # Log command on server side only
@@ -362,6 +591,12 @@ def remove_client(client_socket):
 
         # Remove the client from our dictionaries
         del clients[client_socket]
+        del outboxes[client_socket]
+        if capture:
+            capture.closed(client_socket)
+
+        # Cancel its uploads and forget downloads it never started
+        relay.drop_client(client_socket)
 
         # Close the client socket
         client_socket.close()
@@ -372,10 +607,21 @@ def remove_client(client_socket):
         # Broadcast to other clients
         broadcast_message(f"User '{username}' has left the chat.", None, MessageType.USER_EVENT)
 
-def main():
-    """Main function to start the server."""
+def main(capture_path=None):
+    """
+    Main function to start the server.
+
+    Args:
+        capture_path: File to record inbound chat traffic to for replay.py (optional)
+    """
+    global capture
+
     logger.info(f"Starting TCP Chat Server on {HOST}:{PORT}")
 
+    if capture_path:
+        capture = TraceWriter(capture_path)
+        logger.info(f"Capturing inbound traffic to {capture_path}")
+
     # Create a TCP socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -385,6 +631,11 @@ def main():
     # Set the server socket to non-blocking mode
     server_socket.setblocking(0)
 
+    # Create a second listening socket for file transfer data connections
+    transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    transfer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    transfer_socket.setblocking(0)
+
     try:
         # Bind the socket to the address and port
         server_socket.bind((HOST, PORT))
@@ -392,16 +643,45 @@ def main():
         # Listen for incoming connections (queue up to 5 connection requests)
         server_socket.listen(5)
         logger.info(f"Listening for connections on {HOST}:{PORT}")
+
+        transfer_socket.bind((HOST, TRANSFER_PORT))
+        transfer_socket.listen(5)
+        logger.info(f"Listening for file transfers on {HOST}:{TRANSFER_PORT}")
         logger.info(f"Server started at {get_timestamp()}")
 
+        # Start the offline mailbox worker
+        try:
+            mailbox.start()
+        except sqlite3.Error as e:
+            logger.error(f"Cannot open the offline mailbox {mailbox.path}: {e}")
+            return
+
         # List of sockets to monitor for input
-        inputs = [server_socket]
+        inputs = [server_socket, transfer_socket, mailbox.wakeup_socket]
 
         while inputs:
             try:
-                # Use select to monitor sockets for input
+                # Hand out this pass's file transfer byte budget
+                relay.start_round()
+
+                # Clients whose outbound messages are backed up
+                backlogged = [sock for sock, outbox in outboxes.items() if outbox.pending()]
+
+                # Use select to monitor sockets for input, backlogged clients for
+                # output, plus the data connections that have transfer work to do
+                # within the budget
                 # The timeout (1 second) allows for keyboard interrupts to be caught
-                readable, _, exceptional = select.select(inputs, [], inputs, 1)
+                readable, writable, exceptional = select.select(
+                    inputs + relay.read_sockets(),
+                    backlogged + relay.write_sockets(),
+                    inputs,
+                    1
+                )
+
+                # Drain backlogged outboxes first, highest priority messages first
+                for sock in writable:
+                    if sock in outboxes:
+                        outboxes[sock].flush(sock)
 
                 # Handle readable sockets (sockets with data to read)
                 for sock in readable:
@@ -411,6 +691,16 @@ def main():
                         new_client = handle_new_connection(server_socket)
                         # Add the new client to our list of inputs to monitor
                         inputs.append(new_client)
+                    # A client is opening a file transfer data connection
+                    elif sock is transfer_socket:
+                        relay.accept(transfer_socket)
+                    # The offline mailbox has fetched messages for connected users
+                    elif sock is mailbox.wakeup_socket:
+                        for client_socket, username, messages in mailbox.completed():
+                            deliver_offline_messages(client_socket, username, messages)
+                    # Data connections are handled after chat traffic below
+                    elif relay.owns(sock):
+                        continue
                     # Otherwise, an existing client is sending a message
                     else:
                         # Handle the client message
@@ -427,6 +717,27 @@ def main():
                         inputs.remove(sock)
                     remove_client(sock)
 
+                # Disconnect clients that stopped reading the replies to their own commands
+                for sock in [sock for sock, outbox in outboxes.items() if outbox.overflowed]:
+                    logger.warning(f"Disconnecting {get_username(sock)}: too many unread replies")
+                    if sock in inputs:
+                        inputs.remove(sock)
+                    remove_client(sock)
+
+                # Relay file data only after chat traffic has been handled, so each
+                # pass adds at most one round budget of bulk work to chat latency
+                for sock in readable:
+                    if relay.owns(sock):
+                        relay.handle_readable(sock)
+                for sock in writable:
+                    if relay.owns(sock):
+                        relay.handle_writable(sock)
+                relay.expire()
+
+                # Write captured traffic to disk regularly, even when clients go quiet
+                if capture:
+                    capture.flush_if_due()
+
             except KeyboardInterrupt:
                 logger.warning("Server interrupted by user")
                 break
@@ -438,11 +749,25 @@ def main():
         for sock in clients:
             sock.close()
 
-        # Close the server socket
+        # Close any file transfer data connections
+        relay.close_all()
+
+        # Write any queued offline messages to disk
+        mailbox.close()
+
+        # Finish the traffic capture
+        if capture:
+            capture.close()
+
+        # Close the listening sockets
         if server_socket:
             server_socket.close()
+        transfer_socket.close()
 
         logger.info("Server is shutting down")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="TCP Chat Server")
+    parser.add_argument('--capture', metavar='PATH', help="record inbound chat traffic to a trace file for replay.py")
+    args = parser.parse_args()
+    main(capture_path=args.capture)
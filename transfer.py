@@ -0,0 +1,405 @@
+"""
+TCP Chat Application - File Transfer Relay
+
+This module implements the server side of chunked file transfers. File data never
+travels over the chat connections: uploaders and receivers open separate data
+connections on TRANSFER_PORT and the server relays the file between them in chunks.
+A deficit round-robin scheduler limits how many bytes transfers may move on each
+pass of the server loop, so bulk uploads cannot delay chat delivery.
+"""
+import time
+import logging
+import secrets
+from collections import deque
+
+from common import TRANSFER_CHUNK_SIZE, TRANSFER_PUT, TRANSFER_GET, MessageType
+
+logger = logging.getLogger('server')
+
+TRANSFER_WINDOW = 4 * TRANSFER_CHUNK_SIZE       # Maximum bytes buffered per transfer
+TRANSFER_ROUND_BUDGET = 2 * TRANSFER_CHUNK_SIZE  # Bytes all transfers may move per server loop pass
+TRANSFER_MIN_SHARE = 4 * 1024                   # Smallest per-transfer share of the round budget
+ATTACH_TIMEOUT = 10                              # Seconds to wait for data connections to attach
+ACCEPT_TIMEOUT = 30                              # Seconds recipients have to accept a file
+HANDSHAKE_LIMIT = 256                            # Maximum length of a data connection header
+
+
+class Transfer:
+    """State of a single file being relayed from one uploader to its receivers."""
+
+    def __init__(self, token, sender_socket, filename, size):
+        self.token = token
+        self.sender_socket = sender_socket  # Chat socket of the user sending the file
+        self.filename = filename
+        self.size = size
+        self.upload = None      # Data socket of the uploader once it has attached
+        self.pending = {}       # Ticket -> chat socket of receivers that have not attached yet
+        self.receivers = {}     # Data socket -> number of bytes sent to that receiver
+        self.chunks = deque()   # (offset, data) chunks not yet sent to every receiver
+        self.received = 0       # Bytes read from the uploader so far
+        self.deficit = 0        # Scheduler credit in bytes
+        self.created = time.monotonic()
+
+    def buffered(self):
+        """Get the number of bytes held in memory for this transfer."""
+        if not self.chunks:
+            return 0
+        return self.received - self.chunks[0][0]
+
+
+class TransferRelay:
+    """
+    Relay file transfers between data connections.
+
+    The server loop drives the relay: start_round() hands out this pass's byte
+    budget, read_sockets()/write_sockets() tell select() which data connections
+    have work that fits the budget, and handle_readable()/handle_writable() move
+    the bytes. Receivers are fed memoryview slices of the buffered chunks, and the
+    uploader is only read while every receiver is keeping up (TRANSFER_WINDOW),
+    so a slow receiver throttles the upload instead of growing server memory.
+    """
+
+    def __init__(self, notify):
+        """
+        Args:
+            notify: Callable(chat_socket, message_type, content) used to report
+                transfer progress to users over their chat connection
+        """
+        self.notify = notify
+        self.transfers = {}   # Token -> Transfer
+        self.tickets = {}     # Receiver ticket -> Transfer
+        self.sockets = {}     # Attached data socket -> Transfer
+        self.handshakes = {}  # Data socket -> (time accepted, header bytes received so far)
+
+    def create(self, token, sender_socket, filename, size, recipients):
+        """
+        Register a new transfer.
+
+        Args:
+            token: Unique token chosen by the sending client
+            sender_socket: Chat socket of the sending client
+            filename: Name of the file being sent
+            size: Size of the file in bytes
+            recipients: Chat sockets of the users receiving the file
+
+        Returns:
+            A dictionary mapping each recipient chat socket to its download ticket
+        """
+        transfer = Transfer(token, sender_socket, filename, size)
+        tickets = {}
+        for recipient_socket in recipients:
+            # Tickets are random so one recipient cannot guess another's
+            ticket = secrets.token_hex(16)
+            transfer.pending[ticket] = recipient_socket
+            self.tickets[ticket] = transfer
+            tickets[recipient_socket] = ticket
+
+        self.transfers[token] = transfer
+        logger.info(f"Transfer {token}: '{filename}' ({size} bytes) to {len(tickets)} recipient(s)")
+        return tickets
+
+    def owns(self, sock):
+        """Check whether a socket is a data connection managed by the relay."""
+        return sock in self.sockets or sock in self.handshakes
+
+    def accept(self, listen_socket):
+        """Accept a new data connection and wait for its header."""
+        data_socket, address = listen_socket.accept()
+        data_socket.setblocking(0)
+        self.handshakes[data_socket] = (time.monotonic(), bytearray())
+        logger.info(f"Accepted data connection from {address[0]}:{address[1]}")
+
+    def start_round(self):
+        """Share this pass's byte budget among the active transfers."""
+        active = [t for t in self.transfers.values() if t.upload or t.receivers]
+        if not active:
+            return
+
+        share = max(TRANSFER_ROUND_BUDGET // len(active), TRANSFER_MIN_SHARE)
+        for transfer in active:
+            # Credit does not accumulate while a transfer is idle, but an overshoot
+            # from the previous pass is paid back before it may move more bytes
+            transfer.deficit = min(transfer.deficit + share, share)
+
+    def read_sockets(self):
+        """Get the data connections that should be monitored for input."""
+        sockets = list(self.handshakes)
+        for transfer in self.transfers.values():
+            if (transfer.upload and not transfer.pending and transfer.deficit > 0
+                    and transfer.buffered() < TRANSFER_WINDOW
+                    and transfer.received < transfer.size):
+                sockets.append(transfer.upload)
+        return sockets
+
+    def write_sockets(self):
+        """Get the data connections that have file data waiting to be sent."""
+        sockets = []
+        for transfer in self.transfers.values():
+            if transfer.deficit <= 0:
+                continue
+            for data_socket, sent in transfer.receivers.items():
+                if sent < transfer.received:
+                    sockets.append(data_socket)
+        return sockets
+
+    def handle_readable(self, sock):
+        """Read a data connection header or the next chunk of an upload."""
+        if sock in self.handshakes:
+            self._read_handshake(sock)
+            return
+
+        transfer = self.sockets.get(sock)
+        if transfer is None or sock is not transfer.upload:
+            return
+
+        want = min(
+            transfer.deficit,
+            TRANSFER_WINDOW - transfer.buffered(),
+            transfer.size - transfer.received
+        )
+        if want <= 0:
+            return
+
+        try:
+            data = sock.recv(want)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            self.abort(transfer, "the upload ended before the whole file was received")
+            return
+
+        transfer.deficit -= len(data)
+        self._append(transfer, data)
+
+    def handle_writable(self, sock):
+        """Send the next slice of buffered file data to a receiver."""
+        transfer = self.sockets.get(sock)
+        if transfer is None or sock not in transfer.receivers:
+            return
+
+        sent = transfer.receivers[sock]
+        view = self._slice(transfer, sent, max(transfer.deficit, 0))
+        if not view:
+            return
+
+        try:
+            count = sock.send(view)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            logger.error(f"Transfer {transfer.token}: failed to send to receiver: {e}")
+            self._drop_receiver(transfer, sock)
+            return
+
+        transfer.receivers[sock] = sent + count
+        transfer.deficit -= count
+        self._trim(transfer)
+        self._finish_if_done(transfer)
+
+    def expire(self):
+        """
+        Give up on uploads that did not attach within ATTACH_TIMEOUT and on
+        recipients that did not accept the file within ACCEPT_TIMEOUT.
+        """
+        deadline = time.monotonic() - ATTACH_TIMEOUT
+        accept_deadline = time.monotonic() - ACCEPT_TIMEOUT
+
+        # Close data connections that never sent a complete header
+        for sock, (accepted, _) in list(self.handshakes.items()):
+            if accepted <= deadline:
+                del self.handshakes[sock]
+                sock.close()
+
+        for transfer in list(self.transfers.values()):
+            if transfer.created > deadline:
+                continue
+
+            if transfer.upload is None and transfer.received < transfer.size:
+                self.abort(transfer, "the upload did not start in time")
+                continue
+
+            if transfer.pending and transfer.created <= accept_deadline:
+                missed = len(transfer.pending)
+                for ticket in transfer.pending:
+                    self.tickets.pop(ticket, None)
+                transfer.pending.clear()
+                self.notify(
+                    transfer.sender_socket,
+                    MessageType.ERROR,
+                    f"{missed} recipient(s) did not accept '{transfer.filename}' in time."
+                )
+                if not transfer.receivers:
+                    self.abort(transfer, "no recipients accepted the file")
+                else:
+                    self._finish_if_done(transfer)
+
+    def drop_client(self, chat_socket):
+        """Cancel transfers sent by a disconnected user and forget its pending downloads."""
+        for transfer in list(self.transfers.values()):
+            if transfer.sender_socket is chat_socket:
+                self.abort(transfer, "the sender disconnected", notify_sender=False)
+                continue
+
+            for ticket, recipient_socket in list(transfer.pending.items()):
+                if recipient_socket is chat_socket:
+                    del transfer.pending[ticket]
+                    self.tickets.pop(ticket, None)
+
+            if not transfer.pending and not transfer.receivers:
+                self.abort(transfer, "no recipients are left")
+            else:
+                self._finish_if_done(transfer)
+
+    def abort(self, transfer, reason, notify_sender=True):
+        """
+        Cancel a transfer and close its data connections.
+
+        Args:
+            transfer: The transfer to cancel
+            reason: Why the transfer failed (reported to the sender)
+            notify_sender: Whether to tell the sender about the failure
+        """
+        logger.warning(f"Transfer {transfer.token} aborted: {reason}")
+        self._close(transfer)
+        if notify_sender:
+            self.notify(
+                transfer.sender_socket,
+                MessageType.ERROR,
+                f"Transfer of '{transfer.filename}' failed: {reason}."
+            )
+
+    def close_all(self):
+        """Close every data connection (used when the server shuts down)."""
+        for transfer in list(self.transfers.values()):
+            self._close(transfer)
+        for sock in self.handshakes:
+            sock.close()
+        self.handshakes.clear()
+
+    def _read_handshake(self, sock):
+        """Read a "PUT <token>" or "GET <ticket>" header from a new data connection."""
+        _, header = self.handshakes[sock]
+        try:
+            data = sock.recv(HANDSHAKE_LIMIT - len(header))
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+
+        if not data:
+            del self.handshakes[sock]
+            sock.close()
+            return
+
+        header += data
+        if b'\n' not in header:
+            if len(header) >= HANDSHAKE_LIMIT:
+                del self.handshakes[sock]
+                sock.close()
+            return
+
+        del self.handshakes[sock]
+        line, _, rest = bytes(header).partition(b'\n')
+        parts = line.decode('utf-8', errors='replace').split()
+        mode, key = parts if len(parts) == 2 else (None, None)
+
+        if mode == TRANSFER_PUT:
+            transfer = self.transfers.get(key)
+            if transfer is None or transfer.upload is not None or len(rest) > transfer.size:
+                sock.close()
+                return
+            transfer.upload = sock
+            self.sockets[sock] = transfer
+            # The client may send file data right behind the header
+            if rest:
+                self._append(transfer, rest)
+            logger.info(f"Transfer {transfer.token}: upload attached")
+
+        elif mode == TRANSFER_GET and key in self.tickets:
+            transfer = self.tickets.pop(key)
+            transfer.pending.pop(key, None)
+            transfer.receivers[sock] = 0
+            self.sockets[sock] = transfer
+            logger.info(f"Transfer {transfer.token}: receiver attached ({key})")
+            self._finish_if_done(transfer)
+
+        else:
+            sock.close()
+
+    def _append(self, transfer, data):
+        """Buffer a chunk read from the uploader."""
+        transfer.chunks.append((transfer.received, data))
+        transfer.received += len(data)
+
+        if transfer.received == transfer.size and transfer.upload:
+            # The whole file is buffered or relayed; the upload connection is done
+            self.sockets.pop(transfer.upload, None)
+            transfer.upload.close()
+            transfer.upload = None
+
+        self._finish_if_done(transfer)
+
+    def _slice(self, transfer, offset, limit):
+        """Get a zero-copy view of up to limit buffered bytes starting at offset."""
+        for start, data in transfer.chunks:
+            if start <= offset < start + len(data):
+                begin = offset - start
+                return memoryview(data)[begin:begin + limit]
+        return None
+
+    def _trim(self, transfer):
+        """Release chunks that every receiver has been sent."""
+        if transfer.pending:
+            return
+        low = min(transfer.receivers.values(), default=transfer.received)
+        while transfer.chunks and transfer.chunks[0][0] + len(transfer.chunks[0][1]) <= low:
+            transfer.chunks.popleft()
+
+    def _drop_receiver(self, transfer, sock):
+        """Stop relaying to a receiver whose data connection failed."""
+        del transfer.receivers[sock]
+        self.sockets.pop(sock, None)
+        sock.close()
+
+        if not transfer.pending and not transfer.receivers:
+            self.abort(transfer, "no recipients are left")
+        else:
+            self._trim(transfer)
+            self._finish_if_done(transfer)
+
+    def _finish_if_done(self, transfer):
+        """Complete a transfer once every attached receiver has the whole file."""
+        if transfer.token not in self.transfers:
+            return
+        if transfer.received < transfer.size or transfer.pending or not transfer.receivers:
+            return
+        if any(sent < transfer.size for sent in transfer.receivers.values()):
+            return
+
+        delivered = len(transfer.receivers)
+        self._close(transfer)
+        logger.info(f"Transfer {transfer.token} complete: delivered to {delivered} recipient(s)")
+        self.notify(
+            transfer.sender_socket,
+            MessageType.COMMAND_RESULT,
+            f"File '{transfer.filename}' delivered to {delivered} recipient(s)."
+        )
+
+    def _close(self, transfer):
+        """Close a transfer's data connections and forget it."""
+        for ticket in transfer.pending:
+            self.tickets.pop(ticket, None)
+        transfer.pending.clear()
+
+        for data_socket in [transfer.upload, *transfer.receivers]:
+            if data_socket is not None:
+                self.sockets.pop(data_socket, None)
+                data_socket.close()
+
+        transfer.upload = None
+        transfer.receivers.clear()
+        transfer.chunks.clear()
+        self.transfers.pop(transfer.token, None)